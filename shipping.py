@@ -1,10 +1,20 @@
 
 
+import gc
+import operator
 import os
 import time
-from typing import Any, Dict, List, Iterable, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import repeat
+from urllib.parse import urlencode
+from typing import Any, Callable, Deque, Dict, List, Iterable, Optional, Set, Tuple
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
+from requests.adapters import HTTPAdapter
 
 import snowflake.connector
 from snowflake.connector.pandas_tools import write_pandas
@@ -33,6 +43,19 @@ CLIENT_SECRET = _req("ORDORO_CLIENT_SECRET")
 PAGE_LIMIT   = int(os.getenv("PAGE_LIMIT", "100"))
 MAX_RETRIES  = int(os.getenv("MAX_RETRIES", "5"))
 BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", "1.4"))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "8"))
+MAX_PENDING_WRITES = int(os.getenv("MAX_PENDING_WRITES", "4"))
+# 每页只有 PAGE_LIMIT 行，逐页写只会生成一个文件：主线程跨批缓冲到 WRITE_BUFFER_ROWS 行（默认 WRITE_CHUNK_SIZE 的 4 倍）
+# 再交给写入线程，每次 write_pandas 按 WRITE_CHUNK_SIZE 行切成多个 Parquet 文件，WRITE_PARALLEL 个线程并发 PUT。
+# 缓冲保持较小，写入在拉数早期就开始、与 HTTP 重叠，内存里也只留几份缓冲。
+# COPY 阶段能并行载入多少个文件取决于 SF_WAREHOUSE 的规格。写入的是 _STG 表，最后统一 MERGE，缓冲不影响结果
+WRITE_PARALLEL   = int(os.getenv("WRITE_PARALLEL", str(min(16, os.cpu_count() or 4))))
+WRITE_CHUNK_SIZE = int(os.getenv("WRITE_CHUNK_SIZE", "2000"))
+WRITE_BUFFER_ROWS = int(os.getenv("WRITE_BUFFER_ROWS", str(4 * WRITE_CHUNK_SIZE)))
+# 条件请求（ETag）缓存，默认关闭；开启后缓存存放在 Snowflake 表 TABLE_ETAG_CACHE
+USE_ETAG_CACHE = os.getenv("USE_ETAG_CACHE", "0") == "1"
+# keyset 游标翻页（id_gt），API 不支持时自动回退 offset/page
+KEYSET_PAGINATION = os.getenv("KEYSET_PAGINATION", "1") == "1"
 
 SF_USER      = _req("SF_USER")
 SF_ACCOUNT   = _req("SF_ACCOUNT")
@@ -48,6 +71,10 @@ TABLE_PRODUCTS_SNAP    = "INVENTORY_PRODUCT_LEVEL_SNAP"
 TABLE_WAREHOUSES_SNAP  = "INVENTORY_WAREHOUSE_LEVEL_SNAP"
 TABLE_PRODUCTS_HIST    = "INVENTORY_PRODUCT_LEVEL_HIST"
 TABLE_WAREHOUSES_HIST  = "INVENTORY_WAREHOUSE_LEVEL_HIST"
+# 每批先落到临时（TRANSIENT）暂存表，跑完后 MERGE 进 SNAP，由 Snowflake 去重
+TABLE_PRODUCTS_STG     = TABLE_PRODUCTS_SNAP + "_STG"
+TABLE_WAREHOUSES_STG   = TABLE_WAREHOUSES_SNAP + "_STG"
+TABLE_ETAG_CACHE       = "ORDORO_PRODUCT_ETAG_CACHE"
 
 # 这次不写历史表
 ENABLE_HISTORY = False
@@ -74,160 +101,301 @@ def connect_snowflake():
         private_key=pkb,
     )
 
+# ===== HTTP 会话（keep-alive 复用连接）=====
+_SESSION = requests.Session()
+_SESSION.auth = (CLIENT_ID, CLIENT_SECRET)
+# 显式要求压缩响应（requests 自动解压）；装了 brotli/zstandard 时 urllib3 会自动加上 br/zstd
+_SESSION.headers.update({"Accept":"application/json", "Accept-Encoding": requests.utils.DEFAULT_ACCEPT_ENCODING})
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+
 # ===== 请求 + 重试 =====
-def _request_with_retry(url: str, params: dict) -> requests.Response:
+def _request_with_retry(url: str, params: dict, etag: Optional[str] = None) -> Optional[requests.Response]:
+    """带 etag 时发条件请求（If-None-Match），服务端返回 304 则返回 None。"""
+    headers = {"If-None-Match": etag} if etag else None
     attempt = 0
     while True:
         try:
-            r = requests.get(url, params=params, auth=(CLIENT_ID, CLIENT_SECRET),
-                             headers={"Accept":"application/json"}, timeout=60, allow_redirects=False)
+            r = _SESSION.get(url, params=params, headers=headers, timeout=60, allow_redirects=False)
             if r.is_redirect:
                 loc = r.headers.get("Location") or r.headers.get("location")
                 if loc and loc.startswith("http://"):
                     loc = "https://" + loc[len("http://"):]
-                    r = requests.get(loc, auth=(CLIENT_ID, CLIENT_SECRET),
-                                     headers={"Accept":"application/json"}, timeout=60, allow_redirects=False)
+                    r = _SESSION.get(loc, headers=headers, timeout=60, allow_redirects=False)
+            if r.status_code == 304 and etag:
+                return None
             if r.status_code in (429,500,502,503,504):
                 raise requests.HTTPError(f"Retryable status {r.status_code}", response=r)
+            if 400 <= r.status_code < 500:
+                break   # 其余 4xx（如不支持的参数）重试也不会变，直接在循环外抛出
             r.raise_for_status()
             return r
         except requests.RequestException:
             attempt += 1
             if attempt > MAX_RETRIES: raise
             time.sleep(BACKOFF_BASE ** attempt)
+    r.raise_for_status()
 
-# ===== 双模翻页（offset→page）=====
-def iter_products_batches(limit_each: int = PAGE_LIMIT) -> Iterable[List[dict]]:
+# ===== 双模翻页（offset→page）+ 并发预取 =====
+class EtagCache:
     """
-    Ordoro API 分页迭代器：
-    自动在最后一页停止（返回数量 < limit_each 时）。
-    支持 offset 模式与 page 模式。
+    ETag 缓存：页面 key（请求参数）→ (ETag, 响应体)。304 时直接复用缓存的响应体。
+    上次运行的条目取用后即从 previous 移出；只有本次请求过（200 或 304）且非空的页面进入 fresh，
+    其中 200 返回的新响应体记在 changed。保存时只上传 changed 的响应体，其余 fresh 只保留 key，
+    未再访问的旧 key（游标漂移、越过末页的预取）被删除。
     """
-    offset = 0
-    last_first_id: Optional[Any] = None
-    use_page_mode = False
-    page = 1
-
-    while True:
-        params = {"limit": limit_each, ("page" if use_page_mode else "offset"): (page if use_page_mode else offset)}
-        r = _request_with_retry(f"{BASE}/product/", params=params)
-        data = r.json()
-        batch: List[dict] = []
-
-        if isinstance(data, dict):
-            for key in ("product", "products", "results", "data", "items"):
-                if key in data and isinstance(data[key], list):
-                    batch = data[key]
-                    break
-            if not batch and data:
+    def __init__(self, previous: Dict[str, Tuple[str, bytes]]):
+        self.previous = previous
+        self.fresh: Dict[str, Tuple[str, bytes]] = {}
+        self.changed: Set[str] = set()
+
+    def take(self, key: str) -> Optional[Tuple[str, bytes]]:
+        return self.previous.pop(key, None)
+
+    def keep(self, key: str, etag: str, body: bytes, changed: bool):
+        self.fresh[key] = (etag, body)
+        if changed:
+            self.changed.add(key)
+
+def _page_key(params: dict) -> str:
+    return urlencode(sorted(params.items()))
+
+def _fetch_batch(params: dict, etag_cache: Optional[EtagCache] = None) -> List[dict]:
+    page_key = _page_key(params)
+    cached = etag_cache.take(page_key) if etag_cache is not None else None
+    r = _request_with_retry(f"{BASE}/product/", params=params, etag=cached[0] if cached else None)
+    if r is None:
+        etag, body = cached
+    else:
+        etag, body = r.headers.get("ETag"), r.content
+    data = orjson.loads(body)   # 直接解析 bytes，比 r.json() 快且省一次解码
+    batch: List[dict] = []
+
+    if isinstance(data, dict):
+        for key in ("product", "products", "results", "data", "items"):
+            if key in data and isinstance(data[key], list):
+                batch = data[key]
+                break
+        else:
+            if data:
                 batch = [data]
-        elif isinstance(data, list):
-            batch = data
-
+    elif isinstance(data, list):
+        batch = data
+    # 越过末页的空页（含 {"product": []} 这种包装）不缓存，也不再被当成单个对象
+    if etag_cache is not None and etag and batch:
+        etag_cache.keep(page_key, etag, body, changed=r is not None)
+    return batch
+
+def _ascending_ids(batch: List[dict]) -> Optional[List[int]]:
+    """
+    批内的 id（跳过无 id 的条目，main 同样会跳过它们）全为整数且严格递增时返回 id 列表，否则返回 None。
+    """
+    ids = [i for i in ((p or {}).get("id") for p in batch) if i is not None]
+    if all(isinstance(i, int) for i in ids) and all(a < b for a, b in zip(ids, ids[1:])):
+        return ids
+    return None
+
+def _keyset_page_ok(batch: List[dict], cursor: int) -> Optional[List[int]]:
+    """keyset 页有效：id 严格递增且全部大于游标。返回 id 列表，无效时返回 None。"""
+    ids = _ascending_ids(batch)
+    if ids is None or (ids and ids[0] <= cursor):
+        return None
+    return ids
+
+def _probe_keyset(first: List[dict], limit_each: int, etag_cache: Optional[EtagCache]) -> Optional[List[dict]]:
+    """
+    用 id_gt=<首页最后一个 id> 请求第二页，确认服务端支持 keyset 翻页：
+    首页与第二页都按 id 递增、且第二页 id 全部大于游标时返回第二页，否则返回 None。
+    """
+    ids = _ascending_ids(first)
+    if not ids:
+        return None
+    try:
+        batch = _fetch_batch({"limit": limit_each, "id_gt": ids[-1]}, etag_cache)
+    except requests.HTTPError:
+        return None
+    if _keyset_page_ok(batch, ids[-1]) is None:
+        return None
+    return batch
+
+def _iter_keyset(batch: List[dict], limit_each: int, etag_cache: Optional[EtagCache]) -> Iterable[List[dict]]:
+    """batch 为已通过 _probe_keyset 校验的第二页；之后每页都校验，游标取自校验后的 id 列表。"""
+    ids = _ascending_ids(batch)
+    while True:
         if not batch:
             print("📘 No more data, pagination ended.")
-            break
-
-        first_id = (batch[0] or {}).get("id")
-        if not use_page_mode and last_first_id is not None and first_id == last_first_id:
-            use_page_mode = True
-            page = (offset // limit_each) + 2
-            continue
-
+            return
         yield batch
-
         if len(batch) < limit_each:
             print(f"📘 Final batch reached ({len(batch)} records). Stop iteration.")
-            break
+            return
+        if not ids:
+            raise RuntimeError("Keyset pagination: full page without any product id, cannot advance cursor")
+        cursor = ids[-1]
+        batch = _fetch_batch({"limit": limit_each, "id_gt": cursor}, etag_cache)
+        ids = _keyset_page_ok(batch, cursor)
+        if ids is None:
+            raise RuntimeError(
+                f"Keyset pagination: page after id_gt={cursor} is not ascending by id or repeats ids; "
+                "set KEYSET_PAGINATION=0 to use offset/page pagination"
+            )
+
+def _iter_offset_pages(first: List[dict], limit_each: int, workers: int,
+                       etag_cache: Optional[EtagCache]) -> Iterable[List[dict]]:
+    """offset/page 双模：第二页与首页重复说明 offset 不生效，改用 page；之后并发预取。"""
+    use_page_mode = False
 
+    def params_for(i: int) -> dict:
         if use_page_mode:
-            page += 1
-        else:
-            offset += len(batch)
-            last_first_id = first_id
+            return {"limit": limit_each, "page": i + 1}
+        return {"limit": limit_each, "offset": i * limit_each}
+
+    second = _fetch_batch(params_for(1), etag_cache)
+    if second and (second[0] or {}).get("id") == (first[0] or {}).get("id"):
+        use_page_mode = True
+        next_i = 1
+    else:
+        if not second:
+            print("📘 No more data, pagination ended.")
+            return
+        yield second
+        if len(second) < limit_each:
+            print(f"📘 Final batch reached ({len(second)} records). Stop iteration.")
+            return
+        next_i = 2
+
+    pool = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        pending: Deque[Future] = deque()
+        for _ in range(max(1, workers)):
+            pending.append(pool.submit(_fetch_batch, params_for(next_i), etag_cache))
+            next_i += 1
+        while pending:
+            batch = pending.popleft().result()
+            if not batch:
+                print("📘 No more data, pagination ended.")
+                break
+            yield batch
+            if len(batch) < limit_each:
+                print(f"📘 Final batch reached ({len(batch)} records). Stop iteration.")
+                break
+            pending.append(pool.submit(_fetch_batch, params_for(next_i), etag_cache))
+            next_i += 1
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def iter_products_batches(limit_each: int = PAGE_LIMIT, workers: int = FETCH_WORKERS,
+                          etag_cache: Optional[EtagCache] = None,
+                          keyset: bool = KEYSET_PAGINATION) -> Iterable[List[dict]]:
+    """
+    Ordoro API 分页迭代器：
+    自动在最后一页停止（返回数量 < limit_each 时）。
+    优先用 keyset 游标（id_gt=<上一页最后一个 id>）顺序翻页，服务端无需每次跳过 offset 行；
+    探测发现服务端不支持时回退到 offset/page 双模，最多 workers 个页面并发请求，按顺序产出。
+    传入 etag_cache 时每页走条件请求，并把新的 ETag/响应体写回缓存。
+    """
+    first = _fetch_batch({"limit": limit_each, "offset": 0}, etag_cache)
+    if not first:
+        print("📘 No more data, pagination ended.")
+        return
+    yield first
+    if len(first) < limit_each:
+        print(f"📘 Final batch reached ({len(first)} records). Stop iteration.")
+        return
+
+    if keyset:
+        second = _probe_keyset(first, limit_each, etag_cache)
+        if second is not None:
+            yield from _iter_keyset(second, limit_each, etag_cache)
+            return
+        print("📘 id_gt not honored by API, falling back to offset/page pagination.")
+
+    yield from _iter_offset_pages(first, limit_each, workers, etag_cache)
 
 # ===== 文本清洗 =====
-def _safe_str(x):
-    s = str(x) if x is not None else ""
-    return s.replace("|","/").replace(":", "：")
+# 逐产品只抽取原始文本，用控制字符做临时分隔；"|"/":" 的替换在建好 DataFrame 后整列向量化完成
+_ITEM_SEP = "\x1f"   # 清洗后变为 "|"
+_PART_SEP = "\x1e"   # 清洗后变为 ":"
+
+def _as_text(x) -> str:
+    return str(x) if x is not None else ""
 
 def _join_tags(tags_obj)->str:
     out=[]
     if isinstance(tags_obj,list):
         for t in tags_obj:
-            if isinstance(t,str): out.append(_safe_str(t))
+            if isinstance(t,str): out.append(t)
             elif isinstance(t,dict):
                 v=t.get("name") or t.get("label") or t.get("tag") or t.get("value") or t.get("title")
-                out.append(_safe_str(v if isinstance(v,str) else t))
-            else: out.append(_safe_str(t))
+                out.append(v if isinstance(v,str) else str(t))
+            else: out.append(_as_text(t))
     elif isinstance(tags_obj,dict):
         v=tags_obj.get("name") or tags_obj.get("label") or tags_obj.get("tag") or tags_obj.get("value") or tags_obj.get("title")
-        if v: out.append(_safe_str(v))
-    elif isinstance(tags_obj,str): out.append(_safe_str(tags_obj))
-    return "|".join(out)
+        if v: out.append(_as_text(v))
+    elif isinstance(tags_obj,str): out.append(tags_obj)
+    return _ITEM_SEP.join(out)
+
+def _cart_text(c: Dict[str, Any]) -> str:
+    vendor=c.get("vendor") or c.get("channel") or c.get("platform") or c.get("site") or ""
+    name=c.get("name") or c.get("store") or c.get("account") or ""
+    return _PART_SEP.join(t for t in (_as_text(vendor), _as_text(name)) if t)
 
 def _join_carts(carts_obj)->str:
     out=[]
     if isinstance(carts_obj,list):
         for c in carts_obj:
-            if isinstance(c,dict):
-                vendor=c.get("vendor") or c.get("channel") or c.get("platform") or c.get("site") or ""
-                name=c.get("name") or c.get("store") or c.get("account") or ""
-                out.append(f"{_safe_str(vendor)}:{_safe_str(name)}".strip(":"))
-            else: out.append(_safe_str(c))
-    elif isinstance(carts_obj,dict):
-        vendor=carts_obj.get("vendor") or c.get("channel") or c.get("platform") or c.get("site") or ""
-        name=carts_obj.get("name") or c.get("store") or c.get("account") or ""
-        out.append(f"{_safe_str(vendor)}:{_safe_str(name)}".strip(":"))
-    elif isinstance(carts_obj,str): out.append(_safe_str(carts_obj))
-    return "|".join(out)
+            if isinstance(c,dict): out.append(_cart_text(c))
+            else: out.append(_as_text(c))
+    elif isinstance(carts_obj,dict): out.append(_cart_text(carts_obj))
+    elif isinstance(carts_obj,str): out.append(carts_obj)
+    return _ITEM_SEP.join(out)
+
+# 替换顺序有意义：先处理原文里的 "|"/":"，再把临时分隔符还原
+_TEXT_SUBS = (("|", "/"), (":", "："), (_ITEM_SEP, "|"), (_PART_SEP, ":"))
+
+def _clean_text(s: pd.Series) -> pd.Series:
+    """TAGS/CARTS 整列清洗：在 Arrow 字符串数组上用 pyarrow.compute 的 C++ 内核逐字节替换，不经过 Python 逐元素调用。"""
+    arr = pa.array(s, type=pa.large_string(), from_pandas=True)
+    for pattern, replacement in _TEXT_SUBS:
+        arr = pc.replace_substring(arr, pattern, replacement)
+    return pd.Series(arr, index=s.index, dtype=pd.ArrowDtype(arr.type), copy=False)
 
 # ===== 字段映射 =====
 def _is_archived_like(p: Dict[str,Any]) -> bool:
     return bool(p.get("archived") or p.get("is_archived") or p.get("deleted") or p.get("is_deleted"))
 
-def base_product_cols(p: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+# Ordoro 字段名，顺序与 PRODUCT_TARGET_COLS 前 19 列一致（TAGS/CARTS 单独拼接）
+_PRODUCT_KEYS = (
+    "id", "sku", "name", "price", "cost", "upc", "asin", "country_of_origin", "updated",
+    "total_on_hand", "total_available", "total_committed", "total_allocated",
+    "total_unallocated", "total_mfg_ordered", "to_be_shipped", "height", "weight", "width",
+)
+_PRODUCT_GETTER = operator.itemgetter(*_PRODUCT_KEYS)
+
+def base_product_cols(p: Dict[str, Any]) -> Optional[Tuple[Any, ...]]:
+    """按 PRODUCT_TARGET_COLS 的顺序返回位置元组。"""
     if FILTER_ARCHIVED and _is_archived_like(p): return None
-    return {
-        "PRODUCT_ID": p.get("id"),
-        "SKU": p.get("sku"),
-        "NAME": p.get("name"),
-        "PRICE": p.get("price"),
-        "COST": p.get("cost"),
-        "UPC": p.get("upc"),
-        "ASIN": p.get("asin"),
-        "COUNTRY": p.get("country_of_origin"),
-        "UPDATED": p.get("updated"),
-        "TOTAL_ON_HAND": p.get("total_on_hand"),
-        "TOTAL_AVAILABLE": p.get("total_available"),
-        "TOTAL_COMMITTED": p.get("total_committed"),
-        "TOTAL_ALLOCATED": p.get("total_allocated"),
-        "TOTAL_UNALLOCATED": p.get("total_unallocated"),
-        "TOTAL_MFG_ORDERED": p.get("total_mfg_ordered"),
-        "TO_BE_SHIPPED": p.get("to_be_shipped"),
-        "HEIGHT": p.get("height"),
-        "WEIGHT": p.get("weight"),
-        "WIDTH": p.get("width"),
-        "TAGS": _join_tags(p.get("tags")),
-        "CARTS": _join_carts(p.get("carts") or []),
-    }
-
-def rows_for_warehouses(p: Dict[str, Any]) -> List[Dict[str, Any]]:
-    rows=[]; base=base_product_cols(p)
-    if base is None: return rows
+    try:
+        vals = _PRODUCT_GETTER(p)            # 字段齐全时一次 C 调用取完
+    except KeyError:
+        vals = tuple(map(p.get, _PRODUCT_KEYS))   # 缺字段时逐个 get，缺失为 None
+    return vals + (_join_tags(p.get("tags")), _join_carts(p.get("carts") or []))
+
+def rows_for_warehouses(p: Dict[str, Any]) -> List[Tuple[Any, ...]]:
+    """只返回仓库级字段（按 WAREHOUSE_ONLY_COLS 顺序的元组）；产品级字段由调用方按仓库行数整列复制。"""
+    rows=[]
     for w in (p.get("warehouses") or []):
         if not isinstance(w,dict): continue
-        rows.append({ **base,
-            "WH_ID": w.get("id"), "WH_NAME": w.get("warehouse_name"),
-            "WH_UPDATED": w.get("updated"), "WH_CREATED": w.get("warehouse_created_date"),
-            "WH_LAST_CHANGE": w.get("warehouse_updated_date"),
-            "LOW_STOCK_THTD": w.get("low_stock_threshold"), "OOS_THTD": w.get("out_of_stock_threshold"),
-            "POH": w.get("physical_on_hand"), "AOH": w.get("available"),
-            "CMT": w.get("committed"), "OMO": w.get("mfg_ordered"), "OPO": w.get("po_committed"),
-            "ON_HAND": w.get("on_hand"), "ALLOCATED": w.get("allocated"), "UNALLOCATED": w.get("unallocated"),
-            "WH_SHIP_CFG": w.get("is_configured_for_shipping"), "WH_IS_DEFAULT": w.get("is_default_location"),
-            "LOCATION": w.get("location_in_warehouse"),
-        })
+        rows.append((
+            w.get("id"), w.get("warehouse_name"),
+            w.get("updated"), w.get("warehouse_created_date"),
+            w.get("warehouse_updated_date"),
+            w.get("low_stock_threshold"), w.get("out_of_stock_threshold"),
+            w.get("physical_on_hand"), w.get("available"),
+            w.get("committed"), w.get("mfg_ordered"), w.get("po_committed"),
+            w.get("on_hand"), w.get("allocated"), w.get("unallocated"),
+            w.get("is_configured_for_shipping"), w.get("is_default_location"),
+            w.get("location_in_warehouse"),
+        ))
     return rows
 
 # ===== 清洗 =====
@@ -244,42 +412,53 @@ WAREHOUSE_TARGET_COLS = [
     "LOW_STOCK_THTD","OOS_THTD","POH","AOH","CMT","OMO","OPO","ON_HAND","ALLOCATED","UNALLOCATED",
     "WH_SHIP_CFG","WH_IS_DEFAULT","LOCATION",
 ]
+WAREHOUSE_ONLY_COLS = WAREHOUSE_TARGET_COLS[len(PRODUCT_TARGET_COLS):]
 PRODUCT_QTY_COLS = ["TOTAL_ON_HAND","TOTAL_AVAILABLE","TOTAL_COMMITTED","TOTAL_ALLOCATED",
                     "TOTAL_UNALLOCATED","TOTAL_MFG_ORDERED","TO_BE_SHIPPED"]
 WAREHOUSE_QTY_COLS = ["LOW_STOCK_THTD","OOS_THTD","POH","AOH","CMT","OMO","OPO","ON_HAND","ALLOCATED","UNALLOCATED"]
-
-def _strip_tz(series: pd.Series) -> pd.Series:
-    try: return series.dt.tz_convert("UTC").dt.tz_localize(None)
-    except Exception:
-        try: return series.dt.tz_localize(None)
-        except Exception: return series
+TEXT_COLS  = ["TAGS","CARTS"]
+PRICE_COLS = ["PRICE","COST"]
+DIM_COLS   = ["HEIGHT","WEIGHT","WIDTH"]
+PRODUCT_NUMERIC_COLS = ["PRODUCT_ID"] + PRICE_COLS + PRODUCT_QTY_COLS + DIM_COLS
+WAREHOUSE_INT_COLS = WAREHOUSE_QTY_COLS + ["PRODUCT_ID","WH_ID"]
+WAREHOUSE_NUMERIC_COLS = PRICE_COLS + WAREHOUSE_INT_COLS + DIM_COLS
+WAREHOUSE_BOOL_COLS = ["WH_SHIP_CFG","WH_IS_DEFAULT"]
+WAREHOUSE_TS_COLS = ["UPDATED","WH_UPDATED","WH_CREATED","WH_LAST_CHANGE"]
+
+# 整数/布尔/时间列直接落成 Arrow 类型，write_pandas 写 Parquet 时无需再经 numpy/逐格转换
+INT_DTYPE  = pd.ArrowDtype(pa.int64())
+BOOL_DTYPE = pd.ArrowDtype(pa.bool_())
+TS_DTYPE   = pd.ArrowDtype(pa.timestamp("us"))
+
+def _to_utc_naive(series: pd.Series) -> pd.Series:
+    """Ordoro 时间戳统一为 ISO-8601：走 C 快速解析，换算到 UTC 后去掉时区。"""
+    ts = pd.to_datetime(series, format="ISO8601", utc=True, errors="coerce", cache=True).dt.tz_convert(None)
+    return ts.astype(TS_DTYPE)
 
 def clean_products_df(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty: return df.reindex(columns=PRODUCT_TARGET_COLS)
-    if "UPDATED" in df.columns:
-        df["UPDATED"]=pd.to_datetime(df["UPDATED"], errors="coerce"); df["UPDATED"]=_strip_tz(df["UPDATED"])
-    for c in ["PRICE","COST"]:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce").round(2)
-    for c in PRODUCT_QTY_COLS:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce").fillna(0).round(0).astype("Int64")
-    for c in ["HEIGHT","WEIGHT","WIDTH","PRODUCT_ID"]:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce")
-    return df.reindex(columns=PRODUCT_TARGET_COLS)
+    # 调用方按目标列序建表时这里不做 reindex（避免整表复制）；缺列时才补齐
+    if list(df.columns) != PRODUCT_TARGET_COLS: df=df.reindex(columns=PRODUCT_TARGET_COLS)
+    if df.empty: return df
+    df[TEXT_COLS]=df[TEXT_COLS].apply(_clean_text)
+    df["UPDATED"]=_to_utc_naive(df["UPDATED"])
+    # 数值列整块转换，而不是逐列 to_numeric
+    df[PRODUCT_NUMERIC_COLS]=df[PRODUCT_NUMERIC_COLS].apply(pd.to_numeric, errors="coerce")
+    df[PRICE_COLS]=df[PRICE_COLS].round(2)
+    df[PRODUCT_QTY_COLS]=df[PRODUCT_QTY_COLS].fillna(0).round(0).astype(INT_DTYPE)
+    return df
 
 def clean_wh_df(df: pd.DataFrame) -> pd.DataFrame:
-    if df.empty: return df.reindex(columns=WAREHOUSE_TARGET_COLS)
-    for t in ["UPDATED","WH_UPDATED","WH_CREATED","WH_LAST_CHANGE"]:
-        if t in df.columns:
-            df[t]=pd.to_datetime(df[t], errors="coerce"); df[t]=_strip_tz(df[t])
-    for c in ["PRICE","COST"]:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce").round(2)
-    for c in WAREHOUSE_QTY_COLS+["PRODUCT_ID","WH_ID"]:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce").fillna(0).round(0).astype("Int64")
-    for c in ["HEIGHT","WEIGHT","WIDTH"]:
-        if c in df.columns: df[c]=pd.to_numeric(df[c], errors="coerce")
-    for b in ["WH_SHIP_CFG","WH_IS_DEFAULT"]:
-        if b in df.columns: df[b]=df[b].astype("boolean")
-    return df.reindex(columns=WAREHOUSE_TARGET_COLS)
+    # 同上
+    if list(df.columns) != WAREHOUSE_TARGET_COLS: df=df.reindex(columns=WAREHOUSE_TARGET_COLS)
+    if df.empty: return df
+    df[TEXT_COLS]=df[TEXT_COLS].apply(_clean_text)
+    for t in WAREHOUSE_TS_COLS:
+        df[t]=_to_utc_naive(df[t])
+    df[WAREHOUSE_NUMERIC_COLS]=df[WAREHOUSE_NUMERIC_COLS].apply(pd.to_numeric, errors="coerce")
+    df[PRICE_COLS]=df[PRICE_COLS].round(2)
+    df[WAREHOUSE_INT_COLS]=df[WAREHOUSE_INT_COLS].fillna(0).round(0).astype(INT_DTYPE)
+    df[WAREHOUSE_BOOL_COLS]=df[WAREHOUSE_BOOL_COLS].astype(BOOL_DTYPE)
+    return df
 
 # =====（可关的）COPY 错误打印 =====
 def _print_copy_errors(conn, table_fqn: str, limit: int = 50, verbose: bool = False):
@@ -302,19 +481,108 @@ def _print_copy_errors(conn, table_fqn: str, limit: int = 50, verbose: bool = Fa
 def _write_df(conn, df: pd.DataFrame, table: str, verbose: bool = False) -> int:
     ok, nchunks, nrows, _ = write_pandas(
         conn, df, table_name=table, database=SF_DATABASE, schema=SF_SCHEMA,
+        chunk_size=WRITE_CHUNK_SIZE, compression="snappy",
         quote_identifiers=False, use_logical_type=True,
-        on_error="CONTINUE", auto_create_table=False, parallel=4,
+        on_error="CONTINUE", auto_create_table=False, parallel=WRITE_PARALLEL,
     )
     _print_copy_errors(conn, f"{SF_SCHEMA}.{table}", verbose=verbose)
     return int(nrows)
 
+def _clean_and_write(conn, cols: Dict[str, List[Any]], columns: List[str],
+                     clean: Callable[[pd.DataFrame], pd.DataFrame], table: str) -> int:
+    """在写入线程里执行：建 DataFrame → clean → write_pandas。"""
+    df = clean(pd.DataFrame(cols, columns=columns, copy=False))
+    return _write_df(conn, df, table, verbose=False)
+
 # ===== 快照覆盖 =====
-def truncate_snapshots(conn):
+def use_target_schema(conn):
     with conn.cursor() as cur:
         cur.execute(f"USE DATABASE {SF_DATABASE}")
         cur.execute(f"USE SCHEMA {SF_SCHEMA}")
-        cur.execute(f"TRUNCATE TABLE {TABLE_PRODUCTS_SNAP}")
-        cur.execute(f"TRUNCATE TABLE {TABLE_WAREHOUSES_SNAP}")
+
+def create_staging_tables(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE OR REPLACE TRANSIENT TABLE {TABLE_PRODUCTS_STG} LIKE {TABLE_PRODUCTS_SNAP}")
+        cur.execute(f"CREATE OR REPLACE TRANSIENT TABLE {TABLE_WAREHOUSES_STG} LIKE {TABLE_WAREHOUSES_SNAP}")
+
+def _merge_sql(target: str, stage: str, cols: List[str], keys: List[str]) -> str:
+    # 暂存表里同一主键可能出现多次（翻页时数据变动），保留 UPDATED 最新的一行
+    on = " AND ".join(f"EQUAL_NULL(t.{k}, s.{k})" for k in keys)
+    return (
+        f"MERGE INTO {target} t USING ("
+        f"SELECT * FROM {stage} "
+        f"QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(keys)} ORDER BY UPDATED DESC NULLS LAST) = 1"
+        f") s ON {on} "
+        f"WHEN NOT MATCHED THEN INSERT ({', '.join(cols)}) VALUES ({', '.join('s.' + c for c in cols)})"
+    )
+
+def start_merge_staging(conn) -> str:
+    """
+    覆盖今日 SNAP：TRUNCATE 与两条 MERGE 放在同一事务里，作为一个多语句请求用 execute_async 提交，
+    返回 query id。SNAP 在拉数期间保持上一次的完整数据，失败时回滚、不会留下空表。
+    """
+    stmts = [
+        "BEGIN",
+        f"TRUNCATE TABLE {TABLE_PRODUCTS_SNAP}",
+        f"TRUNCATE TABLE {TABLE_WAREHOUSES_SNAP}",
+        _merge_sql(TABLE_PRODUCTS_SNAP, TABLE_PRODUCTS_STG, PRODUCT_TARGET_COLS, ["PRODUCT_ID"]),
+        _merge_sql(TABLE_WAREHOUSES_SNAP, TABLE_WAREHOUSES_STG, WAREHOUSE_TARGET_COLS,
+                   ["PRODUCT_ID", "WH_ID", "WH_UPDATED"]),
+        "COMMIT",
+    ]
+    with conn.cursor() as cur:
+        cur.execute_async(";\n".join(stmts), num_statements=len(stmts))
+        return cur.sfqid
+
+def finish_merge_staging(conn, qid: str, poll_seconds: float = 1.0):
+    """轮询等待事务完成（失败时回滚并抛出异常），再删除暂存表。"""
+    try:
+        while conn.is_still_running(conn.get_query_status_throw_if_error(qid)):
+            time.sleep(poll_seconds)
+    except Exception:
+        with conn.cursor() as cur:
+            cur.execute("ROLLBACK")
+        raise
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE_PRODUCTS_STG}")
+        cur.execute(f"DROP TABLE IF EXISTS {TABLE_WAREHOUSES_STG}")
+
+# ===== ETag 缓存（跨运行保存在 Snowflake）=====
+# SNAP 每次全量重建，所以 304 的页面仍要写入；缓存省掉的是下载与服务端生成整页的开销
+def load_etag_cache(conn) -> EtagCache:
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_ETAG_CACHE} (PAGE_KEY VARCHAR, ETAG VARCHAR, PAYLOAD VARCHAR)")
+        rows = cur.execute(f"SELECT PAGE_KEY, ETAG, PAYLOAD FROM {TABLE_ETAG_CACHE}").fetchall()
+    return EtagCache({k: (e, p.encode("utf-8")) for k, e, p in rows})
+
+def save_etag_cache(conn, cache: EtagCache):
+    """
+    增量保存：本次访问过的 key 全部写入暂存表，但只有 200 的页面带响应体（304 的为 NULL），
+    再在一个事务里删掉未访问的旧 key、MERGE 新的 ETag/响应体。上传失败时旧缓存保持不变。
+    """
+    stage = TABLE_ETAG_CACHE + "_STG"
+    df = pd.DataFrame(
+        [(k, e, p.decode("utf-8") if k in cache.changed else None) for k, (e, p) in cache.fresh.items()],
+        columns=["PAGE_KEY", "ETAG", "PAYLOAD"],
+    )
+    cache.previous.clear()
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE OR REPLACE TRANSIENT TABLE {stage} LIKE {TABLE_ETAG_CACHE}")
+    if not df.empty:
+        write_pandas(conn, df, table_name=stage, database=SF_DATABASE, schema=SF_SCHEMA,
+                     quote_identifiers=False, auto_create_table=False)
+    stmts = [
+        "BEGIN",
+        f"DELETE FROM {TABLE_ETAG_CACHE} WHERE PAGE_KEY NOT IN (SELECT PAGE_KEY FROM {stage})",
+        f"MERGE INTO {TABLE_ETAG_CACHE} t USING (SELECT * FROM {stage} WHERE PAYLOAD IS NOT NULL) s "
+        f"ON t.PAGE_KEY = s.PAGE_KEY "
+        f"WHEN MATCHED THEN UPDATE SET t.ETAG = s.ETAG, t.PAYLOAD = s.PAYLOAD "
+        f"WHEN NOT MATCHED THEN INSERT (PAGE_KEY, ETAG, PAYLOAD) VALUES (s.PAGE_KEY, s.ETAG, s.PAYLOAD)",
+        "COMMIT",
+    ]
+    with conn.cursor() as cur:
+        cur.execute(";\n".join(stmts), num_statements=len(stmts))
+        cur.execute(f"DROP TABLE IF EXISTS {stage}")
 
 # ===== 主流程（只打印总耗时）=====
 def main():
@@ -322,43 +590,84 @@ def main():
     t0 = time.perf_counter()
 
     conn = connect_snowflake()
+    writer: Optional[ThreadPoolExecutor] = None
     try:
-        truncate_snapshots(conn)   # 覆盖今日 SNAP
+        use_target_schema(conn)
+        create_staging_tables(conn)   # SNAP 到最后 start_merge_staging 时才在同一事务里覆盖
 
-        seen_pid=set(); seen_wh=set()
-        prod_snap=wh_snap=0
+        written: Dict[str, int] = {TABLE_PRODUCTS_STG: 0, TABLE_WAREHOUSES_STG: 0}
         batch_idx = 0
 
-        for batch in iter_products_batches(limit_each=PAGE_LIMIT):
+        # 单独的写入线程：上一批在 PUT/COPY 时，主线程继续取下一页并组装列
+        writer = ThreadPoolExecutor(max_workers=1)
+        pending: Deque[Tuple[str, Future]] = deque()
+
+        def _collect(keep: int):
+            while len(pending) > keep:
+                table, fut = pending.popleft()
+                written[table] += fut.result()
+
+        def _submit(vals: List[List[Any]], columns: List[str], clean, table: str):
+            pending.append((table, writer.submit(
+                _clean_and_write, conn, dict(zip(columns, vals)), columns, clean, table)))
+            _collect(MAX_PENDING_WRITES)
+
+        etag_cache = load_etag_cache(conn) if USE_ETAG_CACHE else None
+
+        # 列式（SoA）累积：每列一个 list（与 *_TARGET_COLS 同序）；跨批缓冲到 WRITE_BUFFER_ROWS 行再交给写入线程，
+        # 这样每次 write_pandas 会按 WRITE_CHUNK_SIZE 切成多个文件并发 PUT
+        prod_vals: List[List[Any]] = [[] for _ in PRODUCT_TARGET_COLS]
+        wh_vals: List[List[Any]] = [[] for _ in WAREHOUSE_TARGET_COLS]
+        wh_only_vals = wh_vals[len(PRODUCT_TARGET_COLS):]
+
+        for batch in iter_products_batches(limit_each=PAGE_LIMIT, etag_cache=etag_cache):
             batch_idx += 1
-            prod_rows=[]; wh_rows=[]
             for p in batch:
                 pid=p.get("id")
                 if pid is None:
                     continue
-                if pid not in seen_pid:
-                    row=base_product_cols(p)
-                    if row is not None:
-                        seen_pid.add(pid); prod_rows.append(row)
-                for r in rows_for_warehouses(p):
-                    key=(r.get("PRODUCT_ID"), r.get("WH_ID"), str(r.get("WH_UPDATED")))
-                    if key not in seen_wh:
-                        seen_wh.add(key); wh_rows.append(r)
-
-            if prod_rows:
-                df = clean_products_df(pd.DataFrame(prod_rows))
-                prod_snap += _write_df(conn, df, TABLE_PRODUCTS_SNAP, verbose=False)
-            if wh_rows:
-                df = clean_wh_df(pd.DataFrame(wh_rows))
-                wh_snap += _write_df(conn, df, TABLE_WAREHOUSES_SNAP, verbose=False)
+                base=base_product_cols(p)
+                if base is None:
+                    continue
+                # 去重交给 Snowflake 端的 MERGE（start_merge_staging）完成
+                for col, v in zip(prod_vals, base): col.append(v)
+                wh_rows=rows_for_warehouses(p)
+                if wh_rows:
+                    n=len(wh_rows)
+                    for col, v in zip(wh_vals, base): col.extend(repeat(v, n))
+                    for col, vs in zip(wh_only_vals, zip(*wh_rows)): col.extend(vs)
+
+            if len(prod_vals[0]) >= WRITE_BUFFER_ROWS:
+                _submit(prod_vals, PRODUCT_TARGET_COLS, clean_products_df, TABLE_PRODUCTS_STG)
+                prod_vals = [[] for _ in PRODUCT_TARGET_COLS]
+            if len(wh_vals[0]) >= WRITE_BUFFER_ROWS:
+                _submit(wh_vals, WAREHOUSE_TARGET_COLS, clean_wh_df, TABLE_WAREHOUSES_STG)
+                wh_vals = [[] for _ in WAREHOUSE_TARGET_COLS]
+                wh_only_vals = wh_vals[len(PRODUCT_TARGET_COLS):]
 
             if ENABLE_HISTORY:
                 pass
 
+            # 及时释放本批的 JSON，只回收第 0 代；列数据留在缓冲里，交给写入线程并在 _collect 后才释放
+            del batch
+            gc.collect(0)
+
+        if prod_vals[0]:
+            _submit(prod_vals, PRODUCT_TARGET_COLS, clean_products_df, TABLE_PRODUCTS_STG)
+        if wh_vals[0]:
+            _submit(wh_vals, WAREHOUSE_TARGET_COLS, clean_wh_df, TABLE_WAREHOUSES_STG)
+        del prod_vals, wh_vals, wh_only_vals
+        _collect(0)
+        finish_merge_staging(conn, start_merge_staging(conn))
+        if etag_cache is not None:
+            save_etag_cache(conn, etag_cache)   # 必须在覆盖 SNAP 的事务结束之后，同一会话里的 DDL 会隐式提交它
+
         total_elapsed = time.perf_counter() - t0
         print(f"\n✅ 任务完成，总耗时：{_fmt_dur(total_elapsed)}")
 
     finally:
+        if writer is not None:
+            writer.shutdown(wait=True, cancel_futures=True)
         conn.close()
 
 if __name__ == "__main__":